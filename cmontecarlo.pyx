@@ -11,22 +11,53 @@ np.import_array()
 
 from libc.stdio cimport printf
 from libc.stdlib cimport malloc
+from libc.stdlib cimport calloc
 from libc.stdlib cimport free
-from libc.stdlib cimport rand
-from libc.stdlib cimport srand
-from libc.stdlib cimport RAND_MAX
+from libc.stdint cimport uint64_t
 from libc.math cimport exp
 from libc.math cimport log
+from libc.math cimport ceil
+from libc.math cimport INFINITY
 
 ctypedef unsigned char bool_t
 ctypedef long long int_t
 ctypedef double float_t
+ctypedef int nn_t  # nn index (see HexagonalDirectPosition.nni_arr)
+
+# neighborhood sizes (compile time constants, see McdwPotentialConf)
+cdef enum:
+    NN_MOVE = 3  # nn 1: where an atom can move
+    NN_LANDING = 18  # nn 1 to 4: must be free for an atom to land
+    NN_NEAR = 24  # nn 1 to 5: no empty energy for these in NN6_EmptyEnergy
+    NN_COUNT_MAX = 6  # max number of occupied nn counted in NN6 potentials
+
+
+cdef inline uint64_t rotl(uint64_t x, int k) noexcept nogil:
+    return (x << k) | (x >> (64 - k))
+
+
+# occupancy bitset (1 bit per site)
+cdef inline bint is_occupied(uint64_t* bits, int_t site) noexcept nogil:
+    return (bits[site >> 6] >> (site & 63)) & 1
+
+cdef inline void set_occupied(uint64_t* bits, int_t site) noexcept nogil:
+    bits[site >> 6] |= (<uint64_t>1) << (site & 63)
+
+cdef inline void set_free(uint64_t* bits, int_t site) noexcept nogil:
+    bits[site >> 6] &= ~((<uint64_t>1) << (site & 63))
 
 
 cdef class PotentialFunc:
-    cdef float_t get_energy(self, int_t index):
+    cdef float_t get_energy(self, int_t index) noexcept nogil:
         return 0.0
 
+    cdef void get_energies(self, int_t* indices, int_t n,
+                           float_t* out) noexcept nogil:
+        # energies of a batch of sites
+        cdef int_t i
+        for i in range(n):
+            out[i] = self.get_energy(indices[i])
+
     def __cinit__(self, *args, **kwargs):
         pass
 
@@ -34,8 +65,8 @@ cdef class PotentialFunc:
         pass
 
 cdef class PotentialFuncNN6(PotentialFunc):
-    cdef int_t [:, :] nni  # list of nn index for each position
-    cdef int_t [:] occ  # occupancy of the surface
+    cdef nn_t [:, ::1] nni  # list of nn index for each position
+    cdef uint64_t [::1] occ_bits  # occupancy of the surface (bitset)
     cdef float_t [:] nn_energy  # nn energies
     cdef int_t size   # number of nn to consider
     cdef int_t [:] nn_count  # number of nn at each level
@@ -59,26 +90,24 @@ cdef class PotentialFuncNN6(PotentialFunc):
                     n += 1
 
     def set_surface(self, surface):
-        self.nni = surface.nni
-        self.binding_energy = np.zeros(surface.stlen)
-        cdef int_t i
-        for i in range(surface.stlen):
-            self.binding_energy[i] = surface.sites[surface.sts[i]].energy
+        self.nni = surface.nni_arr
+        self.binding_energy = np.array(surface.ste, dtype=np.float64)
 
     def set_simulator(self, simulator):
-        self.occ = simulator.occupancy_int64
+        self.occ_bits = simulator.occupancy_bits
 
-    cdef float_t get_energy(self, int_t index):
+    cdef float_t get_energy(self, int_t index) noexcept nogil:
         cdef float_t energy = 0.0
 
-        cdef int_t* nni = &self.nni[index, 0]
+        cdef nn_t* nni = &self.nni[index, 0]
+        cdef uint64_t* occ = &self.occ_bits[0]
         cdef int_t i, nn_index, count = 0
 
         for i in range(self.size):
-            if self.occ[nni[i]] > 0:
+            if is_occupied(occ, nni[i]):
                 energy += self.nn_energy[i]
                 count += 1
-            if count == 6:
+            if count == NN_COUNT_MAX:
                 break
         return energy + self.binding_energy[index]
 
@@ -89,52 +118,55 @@ cdef class PotentialFuncNN6_EmptyEnergy(PotentialFuncNN6):
         super().__init__(*args, **kwargs)
         self.empty_energy = empty_energy
 
-    cdef float_t get_energy(self, int_t index):
+    cdef float_t get_energy(self, int_t index) noexcept nogil:
         cdef float_t energy = 0.0
 
-        cdef int_t* nni = &self.nni[index, 0]
+        cdef nn_t* nni = &self.nni[index, 0]
+        cdef uint64_t* occ = &self.occ_bits[0]
         cdef int_t i, nn_index, count = 0
 
         for i in range(self.size):
-            if self.occ[nni[i]] > 0:
+            if is_occupied(occ, nni[i]):
                 energy += self.nn_energy[i]
                 count += 1
             else:
-                if i > 23:
+                if i >= NN_NEAR:
                     energy += self.empty_energy
-            if count == 6:
+            if count == NN_COUNT_MAX:
                 break
         return energy + self.binding_energy[index]
 
 
 cdef class PotentialFuncNN6_EmptyEnergy_2(PotentialFuncNN6_EmptyEnergy):
-    cdef float_t get_energy(self, int_t index):
+    cdef float_t get_energy(self, int_t index) noexcept nogil:
         cdef float_t energy = 0.0
 
-        cdef int_t* nni = &self.nni[index, 0]
+        cdef nn_t* nni = &self.nni[index, 0]
+        cdef uint64_t* occ = &self.occ_bits[0]
         cdef int_t i, nn_index, count = 0
 
         for i in range(self.size):
-            if self.occ[nni[i]] > 0:
-                if count < 6:
+            if is_occupied(occ, nni[i]):
+                if count < NN_COUNT_MAX:
                     energy += self.nn_energy[i]
                     count += 1
             else:
-                if i > 23:
+                if i >= NN_NEAR:
                     energy += self.nn_energy[i] * self.empty_energy
         return energy + self.binding_energy[index]
 
 
 cdef class PotentialFuncNN6_EmptyEnergy_3(PotentialFuncNN6_EmptyEnergy):
-    cdef float_t get_energy(self, int_t index):
+    cdef float_t get_energy(self, int_t index) noexcept nogil:
         cdef float_t energy = 0.0
 
-        cdef int_t* nni = &self.nni[index, 0]
+        cdef nn_t* nni = &self.nni[index, 0]
+        cdef uint64_t* occ = &self.occ_bits[0]
         cdef int_t i, nn_index, count = 0
 
         for i in range(self.size):
-            if self.occ[nni[i]] > 0:
-                if count < 6:
+            if is_occupied(occ, nni[i]):
+                if count < NN_COUNT_MAX:
                     energy += self.nn_energy[i]
                     count += 1
             else:
@@ -142,30 +174,45 @@ cdef class PotentialFuncNN6_EmptyEnergy_3(PotentialFuncNN6_EmptyEnergy):
         return energy + self.binding_energy[index]
 
 
+# potential functions by name (pot_type in the configuration files)
+potential_funcs = {
+    'NN': PotentialFuncNN6,
+    'NN6': PotentialFuncNN6,
+    'NN6_EmptyEnergy': PotentialFuncNN6_EmptyEnergy,
+    'NN6_EmptyEnergy_2': PotentialFuncNN6_EmptyEnergy_2,
+    'NN6_EmptyEnergy_3': PotentialFuncNN6_EmptyEnergy_3,
+}
+
+
 cdef class CMonteCarloSimulator:
     # from initialisation
     cdef readonly int_t lap_max
     cdef readonly int_t steps_per_lap
     cdef readonly int_t moves_per_step
     cdef readonly float_t target_coverage
+    cdef readonly int_t n_target  # number of atoms at target_coverage
     cdef readonly int_t size
     cdef PotentialFunc potential_func
 
     # python object
     cdef public object occupancy_int64
+    cdef public object occupancy_bits
 
     # c accessor
     cdef float_t [:] x
     cdef float_t [:] y
-    cdef int_t [:, :] nni
+    cdef nn_t [:, ::1] nni
+    cdef float_t [:] landing_prob  # relative to the most probable site
+    cdef int_t [::1] traversal_order  # cache friendly order of the sites
 
     # simulation progress
     cdef readonly int_t n_max
     cdef readonly int_t n_used
     cdef readonly int_t n_free
     cdef public float_t kBT
-    cdef readonly float_t energy
-    cdef readonly float_t coverage
+    cdef float_t beta  # 1/kBT, updated at each lap
+    cdef readonly float_t energy  # cache for get_total_energy
+    cdef bint energy_valid  # False when the surface changed since the cache
     cdef readonly int_t lap
     cdef readonly int_t attempted_moves
     cdef readonly int_t successful_moves
@@ -176,12 +223,13 @@ cdef class CMonteCarloSimulator:
     # sites informations
     cdef int_t* filled
     cdef int_t* occ
-
-    # cache (I'm not sure if this help)
-    cdef int_t* _move_cache_nni
-    cdef float_t* _move_cache_p
+    cdef uint64_t* occ_bits  # mirror of occ > 0, 1 bit per site
 
     cdef float_t* _energies_buffer
+    cdef int_t* _sites_buffer
+
+    # random number generator state (xoshiro256**)
+    cdef uint64_t rng_state[4]
 
     def __cinit__(self,
                   int_t nb_binding_sites,
@@ -190,20 +238,22 @@ cdef class CMonteCarloSimulator:
                   int_t moves_per_step,
                   float_t target_coverage,
                   PotentialFunc potential_func,
+                  uint64_t seed=201,
                   *args, **kwargs
                   ):
 
         self.n_max = nb_binding_sites
         self.n_used = 0
         self.n_free = self.n_max
-        self.coverage = 0.0
         self.target_coverage = target_coverage
+        self.n_target = <int_t>ceil(target_coverage * self.n_max)
 
         self.lap_max = lap_max
         self.steps_per_lap = steps_per_lap
         self.moves_per_step = moves_per_step
 
         self.energy = 0.0
+        self.energy_valid = False
         self.temperature = 0.0
         self.kBT = 0.0
         self.potential_func = potential_func
@@ -216,74 +266,143 @@ cdef class CMonteCarloSimulator:
 
         self.filled = <int_t*>malloc(self.n_max * sizeof(int_t))
         self.occ = <int_t*>malloc(self.n_max * sizeof(int_t))
+        self.occ_bits = <uint64_t*>calloc((self.n_max + 63) // 64,
+                                          sizeof(uint64_t))
         self._energies_buffer = <float_t*>malloc(self.n_max * sizeof(float_t))
+        self._sites_buffer = <int_t*>malloc(self.n_max * sizeof(int_t))
 
         cdef int_t i
         for i in range(self.n_max):
             self.filled[i] = i
             self.occ[i] = -i - 1
 
-        self._move_cache_nni = <int_t*>malloc(4 * sizeof(int_t))
-        self._move_cache_p = <float_t*>malloc(4 * sizeof(float_t))
-
-
         # fixed seed for testing
-        srand(201)
+        self.set_seed(seed)
 
     def __dealloc__(self):
         free(self.filled)
         free(self.occ)
-        free(self._move_cache_nni)
-        free(self._move_cache_p)
+        free(self.occ_bits)
         free(self._energies_buffer)
+        free(self._sites_buffer)
 
     def __init__(self,
                  surface,
                  *args, **kwargs):
         self.x = surface.stx
         self.y = surface.sty
-        self.nni = surface.nni
+        self.nni = surface.nni_arr
+
+        # landing probability of each site (sites specifications 'prob')
+        prob = np.array([s.prob for s in surface.sites])[surface.sts]
+        self.landing_prob = prob / prob.max()
+
+        self.traversal_order = np.ascontiguousarray(
+            surface.site_traversal_order, dtype=np.int64)
 
         self.occupancy_int64 = np.PyArray_SimpleNewFromData(
             1, [self.n_max, ], np.NPY_INT64, self.occ)
+        self.occupancy_bits = np.PyArray_SimpleNewFromData(
+            1, [(self.n_max + 63) // 64, ], np.NPY_UINT64, self.occ_bits)
+
+    @property
+    def coverage(self):
+        return self.n_used / <float_t>self.n_max
 
     cpdef run_lap(self):
+        # T = 0: only the lowest energy sites can be chosen (see move)
+        self.beta = 1.0 / self.kBT if self.kBT > 0 else INFINITY
+        with nogil:
+            self.run_lap_kernel()
+        self.lap += 1
+
+    cdef void run_lap_kernel(self) noexcept nogil:
+        # the whole lap in C, without the GIL
         cdef int_t step, move
         for step in range(self.steps_per_lap):
-            if self.coverage < self.target_coverage:
+            if self.n_used < self.n_target:
                 self.add_random_atom()
             for move in range(self.moves_per_step*self.n_used):
                 self.move_random_atom()
-        self.lap += 1
 
-    cdef int_t filled_indexof(self, int_t site_index):
+    cdef int_t filled_indexof(self, int_t site_index) noexcept nogil:
         return abs(self.occ[site_index]) - 1
 
-    cdef void add_atom(self, int_t site_index):
+    cpdef set_seed(self, uint64_t seed):
+        """ Initialize the random number generator state (splitmix64) """
+        cdef uint64_t z
+        cdef int i
+        for i in range(4):
+            seed += 0x9E3779B97F4A7C15ULL
+            z = seed
+            z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+            z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+            self.rng_state[i] = z ^ (z >> 31)
+
+    @cython.final
+    cdef inline uint64_t random_uint64(self) noexcept nogil:
+        # xoshiro256** (http://prng.di.unimi.it/), no lock unlike libc rand()
+        cdef uint64_t* s = self.rng_state
+        cdef uint64_t result = rotl(s[1] * 5, 7) * 9
+        cdef uint64_t t = s[1] << 17
+
+        s[2] ^= s[0]
+        s[3] ^= s[1]
+        s[1] ^= s[2]
+        s[0] ^= s[3]
+        s[2] ^= t
+        s[3] = rotl(s[3], 45)
+        return result
+
+    @cython.final
+    cdef inline int_t random_index(self, int_t n) noexcept nogil:
+        # random integer in [0, n) (scaled instead of modulo, no division)
+        return <int_t>(((self.random_uint64() >> 32) * <uint64_t>n) >> 32)
+
+    @cython.final
+    cdef inline float_t random_uniform(self) noexcept nogil:
+        # random value in [0, 1) (53 bits)
+        return (self.random_uint64() >> 11) * (1.0 / 9007199254740992.0)
+
+    @cython.final
+    cdef inline int_t random_used_site(self) noexcept nogil:
+        # the n_used first entries of filled are the occupied sites
+        return self.filled[self.random_index(self.n_used)]
+
+    @cython.final
+    cdef inline int_t random_free_site(self) noexcept nogil:
+        # the n_free last entries of filled are the free sites
+        return self.filled[self.n_used + self.random_index(self.n_free)]
+
+    cdef void add_atom(self, int_t site_index) noexcept nogil:
         cdef int_t tmp_site_index = self.filled[self.n_used]
         cdef int_t filled_add_index = self.filled_indexof(site_index)
 
         self.occ[site_index] = (self.n_used + 1)
         self.occ[tmp_site_index] = -(filled_add_index + 1)
+        set_occupied(self.occ_bits, site_index)
 
         self.filled[self.n_used] = site_index
         self.filled[filled_add_index] = tmp_site_index
 
         self.n_used += 1
         self.n_free -= 1
-        self.coverage =  self.n_used / <float_t>self.n_max
+        self.energy_valid = False
 
-    cdef void move_atom(self, int_t site_src, int_t site_dst):
+    cdef void move_atom(self, int_t site_src, int_t site_dst) noexcept nogil:
         cdef int_t filled_src_index = self.filled_indexof(site_src)
         cdef int_t filled_dst_index = self.filled_indexof(site_dst)
 
         self.occ[site_src] = -(filled_dst_index + 1)
         self.occ[site_dst] =  (filled_src_index + 1)
+        set_free(self.occ_bits, site_src)
+        set_occupied(self.occ_bits, site_dst)
 
         self.filled[filled_src_index] = site_dst
         self.filled[filled_dst_index] = site_src
+        self.energy_valid = False
 
-    cdef void add_random_atom(self):
+    cdef void add_random_atom(self) noexcept nogil:
         # get a list of landing position available
         if self.n_free == 0:
             printf("!!! Surface totally saturated. Something is wrong !!!")
@@ -295,9 +414,13 @@ cdef class CMonteCarloSimulator:
         cdef int_t site
         cdef int_t can_land = True
         for i in range(self.n_free):
-            site = self.filled[(rand() % self.n_free) + self.n_used]
-            for j in range(18):
-                if self.occ[self.nni[site, j]] > 0:
+            site = self.random_free_site()
+            # rejection on the landing probability of the site
+            if (self.landing_prob[site] < 1.0 and
+                    self.random_uniform() >= self.landing_prob[site]):
+                continue
+            for j in range(NN_LANDING):
+                if is_occupied(self.occ_bits, self.nni[site, j]):
                     can_land = False
                     break
             if can_land:
@@ -307,19 +430,15 @@ cdef class CMonteCarloSimulator:
         printf('!!! Cannot find a nice spot for landing. Atom rejected.\n !!!')
         self.error_adds += 1
 
-    cdef int_t move_random_atom(self):
+    cdef int_t move_random_atom(self) noexcept nogil:
         self.attempted_moves += 1
 
         # chose an atom to move
-        cdef int_t src = self.filled[rand() % self.n_used]
+        cdef int_t src = self.random_used_site()
 
-        # remove source temporary
-        self.occ[src] = -self.occ[src]
-
-
-        # local information about the atom
-        cdef int_t* nni = self._move_cache_nni
-        cdef float_t* p = self._move_cache_p
+        # local information about the atom (on the stack)
+        cdef int_t nni[NN_MOVE + 1]
+        cdef float_t p[NN_MOVE + 1]
 
         # create a list of nn including origin
         nni[0] = src
@@ -327,52 +446,58 @@ cdef class CMonteCarloSimulator:
         nni[2] = self.nni[src, 1]
         nni[3] = self.nni[src, 2]
 
-        cdef int_t i, j
-        # calculate the probability
-
-        p[0] = self.potential_func.get_energy(src)
-        for i in [1, 2, 3]:
-            if self.occ[nni[i]] > 0:
-                # site is occupied
-                p[i] = 0
-            else:
-                # site is free
-                #p[i] = exp(-self.potential_func.get_energy(j)/self.kBT)
-                p[i] = exp(-(self.potential_func.get_energy(nni[i]) - p[0])
-                    / self.kBT)
-
-        #p[0] = 1
-        p[1] += 1
-        p[2] += p[1]
-        p[3] += p[2]
-
-        if p[3] == 0:
-            printf('!!! No place to move !!!\n')
-            self.error_moves += 1
-            return -1
+        # surrounded atom: nowhere to go, no need for the energies
+        if (is_occupied(self.occ_bits, nni[1])
+                and is_occupied(self.occ_bits, nni[2])
+                and is_occupied(self.occ_bits, nni[3])):
+            self.not_moved_moves += 1
+            return 0
 
+        # remove source temporary
+        set_free(self.occ_bits, src)
 
-        p[0] = 1 / p[3]
-        p[1] /= p[3]
-        p[2] /= p[3]
-        #p[3] /= p[3]
+        cdef int_t i, j
+        cdef bint is_free[NN_MOVE + 1]
+        cdef float_t e[NN_MOVE + 1]
+        cdef float_t w[NN_MOVE + 1]
+
+        # energies of the origin and of the free sites (evaluated once)
+        is_free[0] = True
+        e[0] = self.potential_func.get_energy(src)
+        cdef float_t e_min = e[0]
+        for i in range(1, NN_MOVE + 1):
+            is_free[i] = not is_occupied(self.occ_bits, nni[i])
+            if is_free[i]:
+                e[i] = self.potential_func.get_energy(nni[i])
+                if e[i] < e_min:
+                    e_min = e[i]
+
+        # cumulative (not normalized) probabilities. The weights are relative
+        # to the lowest energy: all <= 1 and at least one is 1, no overflow
+        # at low T. At T = 0 (beta = inf) only the lowest energies count.
+        for i in range(NN_MOVE + 1):
+            if not is_free[i]:
+                w[i] = 0
+            elif e[i] == e_min:
+                w[i] = 1
+            else:
+                w[i] = exp(-(e[i] - e_min) * self.beta)
+            p[i] = w[i] if i == 0 else p[i - 1] + w[i]
 
         # chose destination
-        # get a random value between [0, 1]
-        cdef float_t r = <float_t>rand() / <float_t>RAND_MAX
-        cdef int_t dst
-        if r > p[1]:
-            if r > p[2]:
-                dst = nni[3]
-            else:
-                dst = nni[2]
-        else:
-            if r > p[0]:
-                dst = nni[1]
-            else:
-                dst = nni[0]
+        # get a random value between [0, p[3]) instead of normalizing p. The
+        # first site with a weight and r < p[i] is chosen, the last site with
+        # a weight if r was rounded up to p[3].
+        cdef float_t r = p[NN_MOVE] * self.random_uniform()
+        cdef int_t dst = src
+        for i in range(NN_MOVE + 1):
+            if w[i] > 0:
+                dst = nni[i]
+                if r < p[i]:
+                    break
 
-        if self.occ[dst] > 0:
+        # occupied sites have a zero weight, this should never happen
+        if is_occupied(self.occ_bits, dst):
             printf('!!! Moving to an occupied position !!!\n')
             printf("  %5d -> %5d\n", src, dst)
             printf("  p=[%7g %7g %7g %7g]\n", p[0], p[1], p[2], p[3])
@@ -383,24 +508,38 @@ cdef class CMonteCarloSimulator:
             printf("  e=[%7g %7g %7g %7g]\n", p[0], p[1], p[2], p[3])
             self.error_moves += 1
 
-        # put back the atom
-        self.occ[src] = -self.occ[src]
-
         if src == dst:
+            # put back the atom
+            set_occupied(self.occ_bits, src)
             self.not_moved_moves += 1
         else:
             self.successful_moves += 1
-            # move the atom
+            # move the atom (overwrite the source, no need to put it back)
             self.move_atom(src, dst)
 
     cpdef float_t get_total_energy(self):
+        # the sum is only done again if an atom was added or moved
+        if self.energy_valid:
+            return self.energy
+
         cdef int_t size = self.n_used
         cdef float_t* buff = self._energies_buffer
         cdef int_t left = 0
 
-        cdef int_t i
-        for i in range(size):
-            buff[i] = self.potential_func.get_energy(self.filled[i])
+        if size == 0:
+            buff[0] = 0.0
+
+        # occupied sites in traversal order: consecutive sites share most
+        # of their neighbors, the occupancy reads stay in cache
+        cdef int_t* sites = self._sites_buffer
+        cdef int_t i, site, n = 0
+        for i in range(self.n_max):
+            site = self.traversal_order[i]
+            if is_occupied(self.occ_bits, site):
+                sites[n] = site
+                n += 1
+
+        self.potential_func.get_energies(sites, size, buff)
 
         # fancy sum for limiting rounding error
         while size > 1:
@@ -410,7 +549,10 @@ cdef class CMonteCarloSimulator:
                 buff[i] += buff[i+size]
             if left:
                 buff[size-1] += buff[2*size]
-        return buff[0]
+
+        self.energy = buff[0]
+        self.energy_valid = True
+        return self.energy
 
         #return np.sum(buff)
 
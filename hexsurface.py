@@ -10,6 +10,7 @@ from surfacegeo import calculate_sites
 from surfacegeo import geometric_cut_mask
 from surfacegeo import calculate_nn
 from utils import sizeof_fmt
+from lazy import lazy_property
 
 surface_filename = 'surface'
 
@@ -174,6 +175,19 @@ class HexagonalDirectPosition:
     def stlen(self):
         return len(self.stx)
 
+    @lazy_property
+    def nni_arr(self):
+        """ Dense and C-contiguous int32 copy of nni (for cmontecarlo) """
+        return np.ascontiguousarray(self.nni, dtype=np.int32)
+
+    @lazy_property
+    def site_traversal_order(self):
+        """ Sites sorted by blocks of 2 nn radius (cache friendly sweeps) """
+        block = 2 * self.nn_radius * self.a
+        bx = np.floor((self.stx - self.stx.min()) / block)
+        by = np.floor((self.sty - self.sty.min()) / block)
+        return np.lexsort((self.sty, self.stx, bx, by))
+
     @property
     def id_str(self):
         """ Unique identification"""
@@ -218,9 +232,7 @@ class HexagonalDirectPosition:
         t = Timing('Updating sites info (n=%g)' % self.stlen)
         self.stidx = [np.argwhere(self.sts == i)
                       for i in range(len(self.sites))]
-        self.ste = np.zeros(self.stx.shape)
-        for i, idx in enumerate(self.stidx):
-            self.ste[idx] = self.sites[i].energy
+        self.ste = np.array([s.energy for s in self.sites])[self.sts]
 
         t.finished()
 
@@ -73,16 +73,10 @@ if __name__ == "__main__":
 
         # ... quick and dirty
 
-        if pot_type in ['NN', 'NN6']:
-            pot = cmontecarlo.PotentialFuncNN6(**pot_conf)
-        elif pot_type in ['NN6_EmptyEnergy']:
-            pot = cmontecarlo.PotentialFuncNN6_EmptyEnergy(**pot_conf)
-        elif pot_type in ['NN6_EmptyEnergy_2']:
-            pot = cmontecarlo.PotentialFuncNN6_EmptyEnergy_2(**pot_conf)
-        elif pot_type in ['NN6_EmptyEnergy_3']:
-            pot = cmontecarlo.PotentialFuncNN6_EmptyEnergy_3(**pot_conf)
-        else:
-            t.prt("Potential type unknown '%s'" % pot_type)
+        if pot_type not in cmontecarlo.potential_funcs:
+            t.finished("Potential type unknown '%s'. " % pot_type)
+            continue
+        pot = cmontecarlo.potential_funcs[pot_type](**pot_conf)
 
         surface = HexagonalDirectPosition(
             a = 0.362 / np.sqrt(2) / 2,
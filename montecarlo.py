@@ -1,10 +1,12 @@
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.patches import RegularPolygon
 import json
+from queue import Queue
+from threading import Thread
 
 from timing import Timing
+from visualize import hexagon_collection
 import cmontecarlo
 
 kB = 8.6173303e-5 # boltzmann contant in eV/K
@@ -16,6 +18,7 @@ class MonteCarloSimulator(cmontecarlo.CMonteCarloSimulator):
                  temperature_func,
                  output_path,
                  create_image_queue=None,
+                 save_queue_size=16,
                  *args, **kwargs
                  ):
 
@@ -32,6 +35,12 @@ class MonteCarloSimulator(cmontecarlo.CMonteCarloSimulator):
         self.create_image_queue = create_image_queue
         self.outpath = output_path
 
+        # states are written to disk by a thread (see start_saving)
+        self.save_queue_size = save_queue_size
+        self.save_queue = None
+        self.save_thread = None
+        self.save_error = None
+
     @property
     def occupancy(self):
         return self.occupancy_int64 > 0
@@ -80,25 +89,29 @@ class MonteCarloSimulator(cmontecarlo.CMonteCarloSimulator):
                        ('Error adds', '%6d', 12),
                    ])
         self.save_init_state()
-        for i in range(self.lap_max):
-            self.temperature = self.temperature_func(self.lap)
-            self.run_lap()
-
-            stat = self.lap_info
-            self.save_state(stat)
-
-            t.tic(**stat)
-
-            if self.create_image_queue is not None:
-                self.create_image_queue.put(self.lap)
-
-
-        self.save_state()
+        self.start_saving()
+        try:
+            for i in range(self.lap_max):
+                self.temperature = self.temperature_func(self.lap)
+                self.run_lap()
+
+                stat = self.lap_info
+                self.save_state(stat, create_image=True)
+
+                t.tic(**stat)
+
+
+            self.save_state()
+        finally:
+            # also on error (or Ctrl+C): the writer thread and the images
+            # process must not wait forever
+            try:
+                self.stop_saving()
+            finally:
+                if self.create_image_queue is not None:
+                    self.create_image_queue.put('QUIT')
         t.finished()
 
-        if self.create_image_queue is not None:
-            self.create_image_queue.put('QUIT')
-
     def save_init_state(self):
         fn = os.path.join(self.outpath, "init.npz")
         #t = Timing('Saving initial state to %s' % fn)
@@ -114,22 +127,81 @@ class MonteCarloSimulator(cmontecarlo.CMonteCarloSimulator):
         #t.prt('File saved ( %s )' % sizeof_fmt(fn))
         #t.finished()
 
-    def save_stat(self, lap_info=None):
+    def save_stat(self, lap_info=None, lap=None):
         if lap_info is None:
             lap_info = self.lap_info
+        if lap is None:
+            lap = self.lap
 
-        fn = os.path.join(self.outpath, "lap_%.10d.json" % self.lap)
+        fn = os.path.join(self.outpath, "lap_%.10d.json" % lap)
         with open(fn, 'w') as f:
             json.dump(lap_info, f)
 
-    def save_state(self, lap_info=None):
-        fn = os.path.join(self.outpath, "occ_%.10d.npy" % self.lap)
+    def start_saving(self):
+        """ Start the thread writing the states (save_state) to disk. """
+        self.save_queue = Queue(maxsize=self.save_queue_size)
+        self.save_error = None
+        self.save_thread = Thread(target=self._save_worker)
+        self.save_thread.start()
+
+    def stop_saving(self):
+        """ Wait until all the queued states are written to disk. """
+        if self.save_thread is None:
+            return
+        self.save_queue.put(None)
+        self.save_thread.join()
+        self.save_queue = None
+        self.save_thread = None
+        self.raise_save_error()
+
+    def raise_save_error(self):
+        """ Raise the error of the writer thread (if any) in this thread. """
+        error, self.save_error = self.save_error, None
+        if error is not None:
+            raise error
+
+    def _save_worker(self):
+        failed = False
+        while True:
+            state = self.save_queue.get()
+            if state is None:
+                break
+            if failed:
+                # keep emptying the queue: save_state must not block
+                continue
+            try:
+                self.write_state(*state)
+            except BaseException as e:
+                # raised in the simulation thread (save_state, stop_saving)
+                self.save_error = e
+                failed = True
+
+    def save_state(self, lap_info=None, create_image=False):
+        if lap_info is None:
+            lap_info = self.lap_info
+
+        # occupancy is a new array, the simulation can go on
+        state = (self.lap, self.occupancy, lap_info, create_image)
+
+        self.raise_save_error()
+
+        if self.save_thread is None:
+            self.write_state(*state)
+        else:
+            self.save_queue.put(state)
+
+    def write_state(self, lap, occupancy, lap_info, create_image=False):
+        fn = os.path.join(self.outpath, "occ_%.10d.npy" % lap)
         #t = Timing('Saving to %s' % fn)
-        np.save(fn, self.occupancy)
+        np.save(fn, occupancy)
         #t.prt('File saved ( %s )' % sizeof_fmt(fn))
         #t.finished()
 
-        self.save_stat(lap_info)
+        self.save_stat(lap_info, lap)
+
+        # the images process reads the files: only once they are written
+        if create_image and self.create_image_queue is not None:
+            self.create_image_queue.put(lap)
 
 
 
@@ -150,26 +222,24 @@ class MonteCarloSimulator(cmontecarlo.CMonteCarloSimulator):
         fig = plt.figure(figsize=(10,10))
         ax = plt.subplot(111)
 
+        occupancy = self.occupancy
         for i in reversed(range(len(self.surface.stidx))):
             stidx = self.surface.stidx[i]
+            idx = stidx[occupancy[stidx]]
             if symbol == 'scatter':
-                idx = stidx[self.index[stidx]]
                 plt.scatter(
                     self.surface.stx[idx],
                     self.surface.sty[idx],
                     s=10, c=self.surface.sites[i].color, marker='.')
             else:
                 if symbol == 'hexagon':
-                    for idx in stidx[self.index[stidx]]:
-                        ax.add_patch(
-                            RegularPolygon(
-                                (self.surface.stx[idx], self.surface.sty[idx]),
-                                6, # number of vertices
-                                self.surface.a*symbol_scale, # radius
-                                #orientation=np.pi/6,
-                                color=self.surface.sites[i].color,
-                            )
-                        )
+                    # one artist for all the sites of this type
+                    ax.add_collection(hexagon_collection(
+                        self.surface.stx[idx],
+                        self.surface.sty[idx],
+                        self.surface.a*symbol_scale, # radius
+                        self.surface.sites[i].color,
+                    ))
 
 
         axmin = min((self.surface.stx.min(), self.surface.sty.min())) * 1.05
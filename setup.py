@@ -1,8 +1,26 @@
-from distutils.core import setup
+import sys
+from setuptools import setup
+from setuptools import Extension
 from Cython.Build import cythonize
 import numpy
 
+# the MC kernel is compiled ahead of time: optimize it
+if sys.platform == 'win32':
+    extra_compile_args = ['/O2']
+else:
+    extra_compile_args = ['-O3']
+
+extensions = [
+    Extension(
+        'cmontecarlo',
+        ['cmontecarlo.pyx'],
+        include_dirs=[numpy.get_include()],
+        extra_compile_args=extra_compile_args,
+        define_macros=[('NPY_NO_DEPRECATED_API', 'NPY_1_7_API_VERSION')],
+    ),
+]
+
 setup(
-    ext_modules = cythonize('cmontecarlo.pyx'),
-    include_dirs=[numpy.get_include()]
+    ext_modules = cythonize(extensions,
+                            compiler_directives={'language_level': 3}),
 )
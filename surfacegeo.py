@@ -135,23 +135,24 @@ def calculate_nn(stx, sty, nn_radius, idx_list=None,
                                  time_before_first_print=time_before_print
                                  )
 
-    outr = np.zeros(n, dtype=float)
     outless = np.zeros(n, dtype=bool)
     while t.batch_size > 0:
         for i in t.get_range():
-            # calculate distance between i and all (numexp scale better)
-            ne.evaluate('((x - stx)**2 + (y - sty)**2)**(0.5)',
+            # find all inside nn_radius in a single pass (numexp scale
+            # better), comparing squared distances (no sqrt for all)
+            ne.evaluate('(x - stx)**2 + (y - sty)**2 < r2',
                         local_dict={
                             'x': stx[i],
                             'y': sty[i],
                             'stx': stx,
                             'sty': sty,
-                        }, out=outr)
-
-            # keep only those inside nn_radius
-            np.less(outr, nn_radius, out=outless)
+                            'r2': nn_radius**2,
+                        }, out=outless)
             nn_in_id = np.flatnonzero(outless)
-            nn_in_radius = outr[nn_in_id]
+
+            # distances only for those inside nn_radius
+            nn_in_radius = np.sqrt((stx[nn_in_id] - stx[i])**2 +
+                                   (sty[nn_in_id] - sty[i])**2)
 
             # sort with radius (do not include i)
             argsort = np.argsort(nn_in_radius)[1:]
@@ -164,4 +165,10 @@ def calculate_nn(stx, sty, nn_radius, idx_list=None,
 
         t.tic()
     t.finished()
-    return np.array(nni), np.array(nnr)
+    # not the same number of nn for each site (see uniformize_nn). Always a
+    # 1D object array, even if all the sites have the same number of nn
+    nni_out = np.empty(n, dtype=object)
+    nni_out[:] = nni
+    nnr_out = np.empty(n, dtype=object)
+    nnr_out[:] = nnr
+    return nni_out, nnr_out
@@ -10,7 +10,7 @@ import json
 
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.patches import RegularPolygon
+from matplotlib.collections import PolyCollection
 
 from timing import Timing
 
@@ -23,6 +23,15 @@ default_colors_conf = {
     'hcp3': '#D98880',
 }
 
+def hexagon_collection(x, y, radius, colors):
+    """ Same as RegularPolygon((x, y), 6, radius) but a single artist """
+    theta = np.pi/2 + np.arange(6) * np.pi/3
+    hexagon = radius * np.stack((np.cos(theta), np.sin(theta)), axis=1)
+    centers = np.stack((np.ravel(x), np.ravel(y)), axis=1)
+    return PolyCollection(centers[:, None, :] + hexagon[None, :, :],
+                          facecolors=colors, edgecolors=colors)
+
+
 class CreateImages:
     def __init__(self, read_path, write_path,
                  symbol=None,
@@ -79,20 +88,9 @@ class CreateImages:
                 names=loaded['sites_name'],
                 a=loaded['a'],
             )
-        surface.colors = [
+        surface.colors = np.array([
             self.colors_conf[name] for name in surface.names
-        ]
-
-        if self.symbol == 'hexagon':
-            surface.symbols = np.array([
-                RegularPolygon(
-                    (surface.x[i], surface.y[i]),
-                    6, # number of vertices
-                    surface.a*self.symbol_scale, # radius
-                    color=surface.colors[i],
-                    #orientation=np.pi/6,
-                    )
-                for i in range(len(surface.names))])
+        ])
 
         s = 1.1
         surface.xlim = (surface.x.min()*s, surface.x.max()*s)
@@ -114,8 +112,12 @@ class CreateImages:
             c = self.surface.colors[occ]
             self.axis.scatter(x, y, s=10, c=c, marker='.')
         elif self.symbol == 'hexagon':
-            for symbol in self.surface.symbols[occ]:
-                self.axis.add_patch(symbol)
+            self.axis.add_collection(hexagon_collection(
+                self.surface.x[occ],
+                self.surface.y[occ],
+                self.surface.a*self.symbol_scale, # radius
+                self.surface.colors[occ],
+            ))
         else:
             print('Unknown symbol: %s' % self.symbol)
             return